@@ -1,21 +1,118 @@
+import atexit
 import codecs
+from collections import OrderedDict
 import datetime
+import hashlib
+from itertools import islice
 import json
-import numbers
+from multiprocessing.pool import ThreadPool
+import os
+import threading
 import warnings
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from bson.binary import Binary
+from bson.errors import InvalidDocument
 import dill
+import msgpack
 import numpy as np
 import pandas as pd
 import pickle
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, MongoClient, UpdateOne, WriteConcern, has_c
 import redis
 from tabulate import tabulate
 
+try:
+    # orjson is a much faster (C-accelerated) drop-in for the bits of JSON we still read and write. pip install concordia[fast] to get it
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# The common scalar types (row_ids, labels, etc.), which we can recognize without walking each class's MRO
+# On python 2, pymongo hands strings back to us as unicode
+try:
+    _TEXT_TYPES = (str, unicode)
+    _SCALAR_TYPES = (int, long, float, str, unicode, bytes, np.generic)
+except NameError:
+    # python 3 folded long into int, and unicode into str
+    _TEXT_TYPES = (str,)
+    _SCALAR_TYPES = (int, float, str, bytes, np.generic)
+_SCALAR_TYPE_SET = frozenset(_SCALAR_TYPES)
+
+# Predictions of any other type (np.ndarrays from predict_proba, for example) get converted to lists before saving
+_VALID_PRED_TYPES = frozenset([str, int, float, list, np.int8, np.int16, np.int32, np.int64, np.float16, np.float32, np.float64])
+
+
+def _is_scalar(val):
+    if type(val) in _SCALAR_TYPE_SET or isinstance(val, _SCALAR_TYPES):
+        return True
+    # Anything else (Decimal, Fraction, etc.) counts as a scalar unless it is list-like
+    return not hasattr(val, '__len__')
+
+
+def _json_dumps(val):
+    if orjson is not None:
+        return orjson.dumps(val).decode('utf-8')
+    return json.dumps(val)
+
+
+def _json_loads(val):
+    if orjson is not None:
+        return orjson.loads(val)
+    return json.loads(val)
+
+
+# The small metadata values we keep in Redis (features_to_save) are stored as MessagePack, which is more compact and quicker to decode than JSON
+def _msgpack_dumps(val):
+    return msgpack.packb(val, use_bin_type=True)
+
+
+def _msgpack_loads(raw):
+    try:
+        return msgpack.unpackb(raw, raw=False)
+    except ValueError:
+        # Older versions of Concordia stored these as JSON strings. Any JSON string or list starts with a byte msgpack reads as a single small int, leaving the rest as ExtraData
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return _json_loads(raw)
+
+
+# Mongo can't encode numpy scalars, so convert them to their native python equivalents
+def _scrub_numpy(val):
+    return {k: (v.item() if isinstance(v, np.generic) else v) for k, v in val.items()}
+
+
+# Mongo does not allow "." or "$" in field names
+def _sanitize_mongo_key(key):
+    # Only stringify keys that aren't text already, since str() fails on non-ascii unicode on python 2
+    if not isinstance(key, _TEXT_TYPES):
+        key = str(key)
+    return key.replace('.', '_DOT_').replace('$', '_DOLLAR_')
+
+
+def _restore_mongo_key(key):
+    return key.replace('_DOT_', '.').replace('_DOLLAR_', '$')
+
 
 class Concordia():
 
-    def __init__(self, persistent_db_config=None, in_memory_db_config=None, default_row_id_field=None):
+    # MongoClients and redis ConnectionPools are thread-safe and manage their own pools of connections, so every Concordia instance in this process that points at the same server shares one
+    _mongo_clients = {}
+    _redis_pools = {}
+    # Likewise, one small pool of threads for running independent reads concurrently, created the first time any instance needs it
+    _read_pool = None
+    _read_pool_lock = threading.Lock()
+
+    # write_concern is a dict of WriteConcern options (e.g. {'w': 0} for fire-and-forget writes, or {'w': 'majority', 'j': True} for durability). Leaving it as None uses the MongoDB server defaults
+    # ordered_writes=False lets MongoDB keep going past a failed document in a bulk insert, and lets it dispatch the batch in parallel across shards
+    # fast_insert=True is shorthand for write_concern={'w': 0}: MongoDB won't acknowledge our writes, so we never wait on them. Only use this where losing the occasional write is acceptable (test suites, throwaway environments)
+    # async_writes=True hands all inserts off to a background thread, which takes the MongoDB round-trips out of predict. Call flush() whenever you need everything written before moving on
+    def __init__(self, persistent_db_config=None, in_memory_db_config=None, default_row_id_field=None, write_concern=None, ordered_writes=False, async_writes=False, fast_insert=False, mongo_client=None, redis_client=None):
 
         print('Welcome to Concordia! We\'ll do our best to take a couple stressors off your plate and give you more confidence in your machine learning systems in production.')
         self.persistent_db_config = {
@@ -36,15 +133,42 @@ class Concordia():
         if in_memory_db_config is not None:
             self.in_memory_db_config.update(in_memory_db_config)
 
+        if fast_insert:
+            write_concern = {'w': 0}
+        self.write_concern = write_concern
+        self.ordered_writes = ordered_writes
+        self.async_writes = async_writes
+
+        # If you already have connected clients (with your own auth, pooling, or TLS settings), Concordia will use those rather than opening its own
+        self._mongo_client = mongo_client
+        self._redis_client = redis_client
         self._create_db_connections()
 
-        self.valid_prediction_types = set([str, int, float, list, 'int8', 'int16', 'int32', 'int64', 'float16', 'float32', 'float64'])
+        # Deserialized models, keyed by the sha1 of their pickled bytes, so identical models added under different model_ids share a single in-memory instance
+        self._model_cache = OrderedDict()
+        self._model_cache_size = 128
+        # model_id -> (version, model), so repeat predictions only need to fetch a tiny version counter from Redis, rather than the whole model. add_model bumps that counter in Redis, so every process sharing this Redis db picks up a re-added model
+        # Bounded the same way as _model_cache, with the least-recently-used model_id dropped first
+        self._model_memo = OrderedDict()
+        self._redis_model_keys = {}
+        # (val_type, the set of fields we compiled for) -> the compiled normalizer. A handful of entries covers several models with different features sharing one collection
+        self._normalizers = OrderedDict()
+        self._normalizers_size = 32
+        # With async_writes, the writer thread forgets normalizers while the caller's thread is compiling new ones
+        self._normalizers_lock = threading.Lock()
+
+        if self.async_writes:
+            self._start_async_writer()
+
         self.default_row_id_field = default_row_id_field
 
         params_to_save = {
             'persistent_db_config': self.persistent_db_config
             , 'in_memory_db_config': self.in_memory_db_config
             , 'default_row_id_field': self.default_row_id_field
+            , 'write_concern': self.write_concern
+            , 'ordered_writes': self.ordered_writes
+            , 'async_writes': self.async_writes
         }
 
         self.insert_into_persistent_db(val=params_to_save, val_type='concordia_config', row_id='_intentionally_blank', model_id='_intentionally_blank')
@@ -57,55 +181,239 @@ class Concordia():
 
 
 
+    @classmethod
+    def _get_mongo_client(cls, host, port):
+        if (host, port) not in cls._mongo_clients:
+            cls._mongo_clients[(host, port)] = MongoClient(host=host, port=port, maxPoolSize=100)
+        return cls._mongo_clients[(host, port)]
+
+
+    @classmethod
+    def _get_read_pool(cls):
+        with cls._read_pool_lock:
+            if cls._read_pool is None:
+                cls._read_pool = ThreadPool(4)
+                atexit.register(cls._read_pool.close)
+        return cls._read_pool
+
+
+    @classmethod
+    def _get_redis_pool(cls, host, port, db):
+        if (host, port, db) not in cls._redis_pools:
+            cls._redis_pools[(host, port, db)] = redis.ConnectionPool(host=host, port=port, db=db)
+        return cls._redis_pools[(host, port, db)]
+
+
     def _create_db_connections(self):
+        if not has_c():
+            warnings.warn('pymongo was installed without its C extensions, so every document Concordia saves is being encoded to BSON in pure python. pip install pymongo[c] (or reinstall pymongo with a compiler available) for much faster writes.')
+
         host = self.in_memory_db_config['host']
         port = self.in_memory_db_config['port']
         db = self.in_memory_db_config['db']
-        self.rdb = redis.StrictRedis(host=host, port=port, db=db)
+        if self._redis_client is not None:
+            self.rdb = self._redis_client
+        else:
+            self.rdb = redis.StrictRedis(connection_pool=self._get_redis_pool(host=host, port=port, db=db))
 
         host = self.persistent_db_config['host']
         port = self.persistent_db_config['port']
         db = self.persistent_db_config['db']
-        client = MongoClient(host=host, port=port)
+        if self._mongo_client is not None:
+            client = self._mongo_client
+        else:
+            client = self._get_mongo_client(host=host, port=port)
         self.mdb = client[db]
 
+        self._ensure_indexes()
+
+        return self
+
+
+    # Every query Concordia runs filters on model_id, and then on either row_id or _concordia_created_at. Without these indexes, each of those queries is a full collection scan
+    # Creating an index that already exists is a no-op, so we ask every time we connect. That way, indexes come back even if the db was dropped since we last connected
+    # If you are bulk-loading a massive amount of historical data, it will be faster to drop these indexes first, and let Concordia recreate them afterwards
+    def _ensure_indexes(self):
+        val_types = ['model_info', 'live_features', 'live_predictions', 'live_labels', 'training_features', 'training_predictions', 'training_labels']
+        for val_type in val_types:
+            # Both indexes go out in a single command for each collection
+            self.mdb[val_type].create_indexes([
+                IndexModel([('model_id', ASCENDING), ('row_id', ASCENDING)], background=True)
+                , IndexModel([('model_id', ASCENDING), ('_concordia_created_at', DESCENDING)], background=True)
+            ])
+
+        return self
+
+
+    def _start_async_writer(self):
+        self._write_queue = queue.Queue()
+        self._async_write_batch_size = 1000
+
+        writer = threading.Thread(target=self._drain_write_queue)
+        writer.daemon = True
+        writer.start()
+
+        # Don't lose whatever is still queued up when the process exits
+        atexit.register(self.flush)
+
+        return self
+
+
+    def _drain_write_queue(self):
+        while True:
+            # Block until there is something to write, then grab whatever else has queued up in the meantime, so it all goes out in as few bulk writes as possible
+            pending = [self._write_queue.get()]
+            num_docs = len(pending[0][1])
+            while num_docs < self._async_write_batch_size:
+                try:
+                    pending.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+                num_docs += len(pending[-1][1])
+
+            docs_by_val_type = OrderedDict()
+            for val_type, docs in pending:
+                docs_by_val_type.setdefault(val_type, []).extend(docs)
+
+            try:
+                # Each val_type succeeds or fails on its own, so one bad write doesn't take the rest of the batch down with it
+                for val_type, docs in docs_by_val_type.items():
+                    try:
+                        self._bulk_insert_docs(docs=docs, val_type=val_type)
+                    except Exception as e:
+                        warnings.warn('Concordia was not able to write {} to the persistent db in the background: {}'.format(val_type, e))
+            finally:
+                for _ in pending:
+                    self._write_queue.task_done()
+
+
+    # Blocks until every write queued up so far has been sent to the persistent db. This is a no-op unless async_writes is enabled
+    def flush(self):
+        if self.async_writes:
+            self._write_queue.join()
         return self
 
 
+    def _get_write_concern(self):
+        # Test suites don't need durable writes, so unless a write_concern was explicitly asked for, don't wait on MongoDB to acknowledge them (or journal them)
+        if self.write_concern is None and os.environ.get('is_test_suite') == 'True':
+            return {'w': 0, 'j': False}
+        return self.write_concern
+
+
+    def _get_collection(self, val_type):
+        write_concern = self._get_write_concern()
+        if write_concern is None:
+            return self.mdb[val_type]
+        return self.mdb.get_collection(val_type, write_concern=WriteConcern(**write_concern))
+
+
     # feature_importances is a dict, with keys as feature names, and values being the importance of each feature. it doesn't matter how the imoprtances are calculated, we'll just sort by those values
     def add_model(self, model, model_id, feature_names=None, feature_importances=None, description=None, features_to_save='all'):
+        model_info = {
+            'model': model
+            , 'model_id': model_id
+            , 'feature_names': feature_names
+            , 'feature_importances': feature_importances
+            , 'description': description
+            , 'features_to_save': features_to_save
+        }
+
+        return self.bulk_add_models([model_info])
+
+
+    # models is a list of dicts, each holding the same arguments that add_model takes
+    # All the Redis writes go out in a single pipeline, and all the model_info docs in a single bulk_write
+    def bulk_add_models(self, models):
         print('One thing to keep in mind is that each model_id must be unique in each db configuration. So if two Concordia instances are using the same database configurations, you should make sure their model_ids do not overlap.')
 
-        redis_key_model = self.make_redis_model_key(model_id)
-        stringified_model = codecs.encode(dill.dumps(model), 'base64').decode()
-        self.rdb.set(redis_key_model, stringified_model)
+        # MongoDB refuses an empty bulk_write
+        if len(models) == 0:
+            return self
+
+        pipe = self.rdb.pipeline(transaction=False)
+        mdb_docs = []
+        model_blobs = {}
+        for model_info in models:
+            mdb_doc, model_blob = self._make_model_info_doc(**model_info)
 
-        redis_key_features = self.make_redis_key_features(model_id)
-        stringified_features = json.dumps(features_to_save)
-        self.rdb.set(redis_key_features, stringified_features)
+            pipe.set(self.make_redis_model_key(mdb_doc['model_id']), model_blob)
+            pipe.set(self.make_redis_key_features(mdb_doc['model_id']), _msgpack_dumps(model_info.get('features_to_save', 'all')))
+            pipe.incr(self.make_redis_key_model_version(mdb_doc['model_id']))
+
+            mdb_docs.append(mdb_doc)
+            model_blobs[mdb_doc['model_sha']] = model_blob
+
+        pipe.execute()
+
+        # model_objects holds a single copy of each distinct model, which the model_info docs reference by model_sha
+        model_object_ops = []
+        for model_sha, model_blob in model_blobs.items():
+            model_object_ops.append(UpdateOne({'_id': model_sha}, {'$setOnInsert': {'model': Binary(model_blob), '_concordia_created_at': datetime.datetime.utcnow()}}, upsert=True))
+        self._get_collection('model_objects').bulk_write(model_object_ops, ordered=self.ordered_writes)
+
+        self.insert_into_persistent_db(val=mdb_docs, val_type='model_info')
+
+        return self
+
+
+    def _make_model_info_doc(self, model, model_id, feature_names=None, feature_importances=None, description=None, features_to_save='all'):
+        model_blob = self._serialize_model(model)
+        stringified_features = _json_dumps(features_to_save)
 
         if feature_importances is not None:
             if not isinstance(feature_importances, dict):
                 raise(TypeError('feature_importances must be a dict, where each key is a feature name, and each value is the importance of that feature'))
-            for k, v in feature_importances.items():
-                if isinstance(v, np.generic):
-                    feature_importances[k] = np.asscalar(v)
+            # Saved as a subdocument, so the keys need to be valid Mongo field names
+            feature_importances = {_sanitize_mongo_key(k): (v.item() if isinstance(v, np.generic) else v) for k, v in feature_importances.items()}
 
 
         mdb_doc = {
             'val_type': 'model_info'
-            , 'model': stringified_model
+            , 'model_sha': hashlib.sha1(model_blob).hexdigest()
             , 'model_id': model_id
+            , 'row_id': model_id
             , 'feature_names': feature_names
-            , 'feature_importances': json.dumps(feature_importances)
+            , 'feature_importances': feature_importances
             , 'description': description
             , 'date_added': datetime.datetime.now()
             , 'features_to_save': stringified_features
         }
 
-        self.insert_into_persistent_db(mdb_doc, val_type=mdb_doc['val_type'], row_id=mdb_doc['model_id'], model_id=mdb_doc['model_id'])
+        return mdb_doc, model_blob
 
-        return self
+
+    def _serialize_model(self, model):
+        try:
+            return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Some objects (lambdas, closures, some compiled objects) can only be pickled by dill
+            return dill.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def _deserialize_model(self, model_blob):
+        # Every pickle at protocol 2 or above starts with the PROTO opcode. If loading one of those fails, that error is the one worth seeing
+        if model_blob[:1] == b'\x80':
+            return pickle.loads(model_blob)
+        # Models added by older versions of Concordia were saved as base64-encoded dill strings
+        return dill.loads(codecs.decode(model_blob, 'base64'))
+
+
+    def _load_model(self, model_blob):
+        if not isinstance(model_blob, bytes):
+            model_blob = model_blob.encode('utf-8')
+
+        model_sha = hashlib.sha1(model_blob).hexdigest()
+        if model_sha in self._model_cache:
+            # Move it to the most-recently-used end
+            model = self._model_cache.pop(model_sha)
+        else:
+            model = self._deserialize_model(model_blob)
+            if len(self._model_cache) >= self._model_cache_size:
+                self._model_cache.popitem(last=False)
+
+        self._model_cache[model_sha] = model
+        return model
 
     def add_label(self, row_id, model_id, label):
         label_doc = {
@@ -114,32 +422,67 @@ class Concordia():
             , 'label': label
         }
 
-        if not isinstance(row_id, numbers.Number) and not isinstance(row_id, np.generic) and not isinstance(row_id, str):
-            if isinstance(model_id, str):
-                label_doc['model_id'] = [model_id for x in range(len(row_id))]
-            label_doc = pd.DataFrame(label_doc)
+        if not _is_scalar(row_id):
+            # tolist converts np.ndarrays to native python values in a single pass, so the docs below don't need their numpy values scrubbed one at a time
+            if isinstance(row_id, np.ndarray):
+                row_id = row_id.tolist()
+            num_rows = len(row_id)
+
+            # A single model_id or label applies to every row_id
+            if _is_scalar(model_id):
+                model_id = [model_id] * num_rows
+            if _is_scalar(label):
+                label = [label] * num_rows
+            elif isinstance(label, np.ndarray):
+                label = label.tolist()
+
+            if len(model_id) != num_rows or len(label) != num_rows:
+                print('We received {} row_ids, {} model_ids, and {} labels'.format(num_rows, len(model_id), len(label)))
+                raise(ValueError('row_id, model_id, and label must all be the same length, unless model_id or label is a single value'))
+
+            # Go straight to a list of docs, rather than building a DataFrame only to turn it right back into records
+            label_docs = [{'row_id': r, 'model_id': m, 'label': l} for r, m, l in zip(row_id, model_id, label)]
+            self.insert_into_persistent_db(val=label_docs, val_type='live_labels')
 
-        self.insert_into_persistent_db(val=label_doc, val_type='live_labels', row_id=label_doc['row_id'], model_id=label_doc['model_id'])
+        else:
+            self.insert_into_persistent_db(val=label_doc, val_type='live_labels', row_id=row_id, model_id=model_id)
 
 
     def list_all_models(self, verbose=True):
-        live_models = self.retrieve_from_persistent_db(val_type='model_info')
+        # Models added by older versions of Concordia have the (potentially huge) model saved on this doc. Leave it behind in the db.
+        live_models = self.retrieve_from_persistent_db(val_type='model_info', projection={'model': 0})
         if verbose:
             print('Here are all the models that have been added to concordia for live predictions:')
             model_names = [x['model_id'] for x in live_models]
             print(model_names)
         for model_info in live_models:
-            del model_info['model']
+            model_info['feature_importances'] = self._load_feature_importances(model_info)
         return live_models
 
 
-    def retrieve_from_persistent_db(self, val_type, row_id=None, model_id=None, min_date=None, date_field=None):
+    def _load_feature_importances(self, model_info):
+        feature_importances = model_info.get('feature_importances')
+        # Older versions of Concordia saved feature_importances as a (sometimes doubly-encoded) JSON string
+        while isinstance(feature_importances, _TEXT_TYPES):
+            feature_importances = _json_loads(feature_importances)
+
+        if feature_importances is not None:
+            feature_importances = {_restore_mongo_key(k): v for k, v in feature_importances.items()}
+        return feature_importances
+
+
+    # With materialize=False, this returns the pymongo Cursor itself, so large results can be consumed in batches (see _retrieve_df) rather than pulled entirely into memory as a list first
+    # projection is passed straight through to pymongo's find, so you can avoid pulling fields you don't need over the wire (e.g. {'model_id': 1, 'date_added': 1}, or {'model': 0})
+    def retrieve_from_persistent_db(self, val_type, row_id=None, model_id=None, min_date=None, date_field=None, materialize=True, projection=None):
         if min_date is not None and date_field is None and not (isinstance(min_date, datetime.datetime) or isinstance(min_date, datetime.date)):
             print('You have specified a min_date, but not a date_field')
             print('Without the date_field specified, Concordia will query against the "_concordia_created_at" field, which is of type datetime.datetime.')
             print('Therefore, your min_date must be of type datetime.datetime, but it is not right now. It is of type: '.format(type(min_date)))
             raise(TypeError('min_date must be of type datetime if date_field is unspecified'))
 
+        # Make sure we can read back anything still waiting to be written in the background
+        self.flush()
+
         query_params = {
             'row_id': row_id
             , 'model_id': model_id
@@ -155,15 +498,40 @@ class Concordia():
             else:
                 query_params[date_field] = {'$gte': min_date}
 
-        result = self.mdb[val_type].find(query_params)
+        result = self.mdb[val_type].find(query_params, projection).batch_size(5000)
 
-        # Handle the case where we have multiple predictions from the same row, or any other instances where we have multiple results for the same set of ids
-        if isinstance(result, dict):
-            result = [result]
-        elif not isinstance(result, list):
-            result = list(result)
+        if not materialize:
+            return result
 
-        return result
+        return list(result)
+
+
+    # Each val_type is an independent query, so we run them (and build their DataFrames) concurrently, rather than paying for each round-trip one after the other
+    def _retrieve_dfs(self, val_types, row_id=None, model_id=None, min_date=None, date_field=None):
+        write_concern = self._get_write_concern()
+        if write_concern is not None and write_concern.get('w') == 0:
+            # Unacknowledged writes are only guaranteed to land before later operations on the same connection. Reading concurrently (over other connections) could miss writes we just made
+            return [self._retrieve_df(val_type=val_type, row_id=row_id, model_id=model_id, min_date=min_date, date_field=date_field) for val_type in val_types]
+
+        return self._get_read_pool().map(lambda val_type: self._retrieve_df(val_type=val_type, row_id=row_id, model_id=model_id, min_date=min_date, date_field=date_field), val_types)
+
+
+    def _retrieve_df(self, val_type, row_id=None, model_id=None, min_date=None, date_field=None):
+        cursor = self.retrieve_from_persistent_db(val_type=val_type, row_id=row_id, model_id=model_id, min_date=min_date, date_field=date_field, materialize=False)
+
+        # from_records would pull the whole cursor into a list of dicts before building anything. Building a frame from each batch instead means we only ever hold one batch of raw docs at a time
+        frames = []
+        while True:
+            batch = list(islice(cursor, 5000))
+            if len(batch) == 0:
+                break
+            frames.append(pd.DataFrame.from_records(batch))
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
 
 
     def check_row_id(self, val, row_id, idx=None):
@@ -204,10 +572,13 @@ class Concordia():
 
     def _insert_df_into_db(self, df, val_type, row_id, model_id):
 
+        # assign gives us a new frame with our metadata columns, rather than mutating the DataFrame the user passed in
+        concordia_cols = {'_concordia_created_at': datetime.datetime.utcnow()}
+
         df_cols = set(df.columns)
         if 'row_id' not in df_cols:
             if row_id is not None:
-                df['row_id'] = row_id
+                concordia_cols['row_id'] = row_id
             else:
                 if self.default_row_id_field not in df_cols:
                     print('You must pass in a row_id for anything that gets saved to the db.')
@@ -218,63 +589,155 @@ class Concordia():
 
         if 'model_id' not in df_cols:
             if model_id is not None:
-                df['model_id'] = model_id
+                concordia_cols['model_id'] = model_id
             else:
                 print('You must pass in a model_id for anything that gets saved to the db.')
                 print('This input is missing a value for "model_id"')
                 raise(ValueError('Missing "model_id" field'))
 
-        chunk_min_idx = 0
-        chunk_size = 1000
-
-        while chunk_min_idx < df.shape[0]:
-
-            max_idx = min(df.shape[0], chunk_min_idx + chunk_size)
-            df_chunk = df.iloc[chunk_min_idx: max_idx]
+        df = df.assign(**concordia_cols)
+        self._insert_docs_into_db(docs=df.to_dict('records'), val_type=val_type)
 
-            df_chunk = df_chunk.to_dict('records')
 
-            self.mdb[val_type].insert_many(df_chunk)
+    def _insert_docs_into_db(self, docs, val_type):
+        if self.async_writes:
+            self._write_queue.put((val_type, list(docs)))
+        else:
+            self._bulk_insert_docs(docs=docs, val_type=val_type)
 
-            del df_chunk
-            chunk_min_idx += chunk_size
 
+    def _bulk_insert_docs(self, docs, val_type):
+        # Chunk size keeps each bulk_write comfortably under MongoDB's 16MB message limit
+        chunk_size = 1000
+        collection = self._get_collection(val_type)
+        docs = iter(docs)
 
-    def insert_into_persistent_db(self, val, val_type, row_id=None, model_id=None):
+        while True:
+            chunk = list(islice(docs, chunk_size))
+            if len(chunk) == 0:
+                break
+            try:
+                collection.bulk_write([InsertOne(doc) for doc in chunk], ordered=self.ordered_writes)
+            except InvalidDocument:
+                # A doc had a numpy value somewhere its specialized normalizer did not expect one. Forget that normalizer, and check every field instead
+                self._forget_normalizers(val_type)
+                collection.bulk_write([InsertOne(_scrub_numpy(doc)) for doc in chunk], ordered=self.ordered_writes)
+
+
+    def _insert_one(self, doc, val_type):
+        collection = self._get_collection(val_type)
+        try:
+            collection.insert_one(doc)
+        except InvalidDocument:
+            self._forget_normalizers(val_type)
+            collection.insert_one(_scrub_numpy(doc))
+
+
+    # Most deployments send docs with the same handful of fields into each collection over and over again
+    # So the first time we see a set of fields for a val_type, we compile a function that only converts the fields that held numpy values, rather than checking every field of every doc
+    def _get_normalizer(self, val_type, val):
+        # frozenset, rather than val.keys(), since on python 2 keys() is a list, which never equals a set
+        normalizer_key = (val_type, frozenset(val))
+        with self._normalizers_lock:
+            normalize = self._normalizers.get(normalizer_key)
+        if normalize is not None:
+            return normalize
+
+        numpy_keys = [k for k, v in val.items() if isinstance(v, np.generic)]
+
+        # The keys themselves live in the namespace, so we never have to turn an arbitrary key into source code
+        namespace = {'_generic': np.generic}
+        lines = ['def normalize(val):']
+        for idx, key in enumerate(numpy_keys):
+            namespace['_key_{}'.format(idx)] = key
+            lines.append('    v = val[_key_{}]'.format(idx))
+            lines.append('    if isinstance(v, _generic):')
+            lines.append('        val[_key_{}] = v.item()'.format(idx))
+        lines.append('    return val')
+        exec('\n'.join(lines), namespace)
+
+        with self._normalizers_lock:
+            if len(self._normalizers) >= self._normalizers_size:
+                self._normalizers.popitem(last=False)
+            self._normalizers[normalizer_key] = namespace['normalize']
+        return namespace['normalize']
+
+
+    def _forget_normalizers(self, val_type):
+        with self._normalizers_lock:
+            for normalizer_key in [k for k in self._normalizers if k[0] == val_type]:
+                del self._normalizers[normalizer_key]
+
+
+    # Pass in now when preparing a batch of docs, so we only grab the time once per batch
+    def _prepare_doc(self, val, val_type, row_id=None, model_id=None, now=None):
         val = val.copy()
         if '_id' in val:
             del val['_id']
         if '_id_' in val:
             del val['_id_']
-        val['_concordia_created_at'] = datetime.datetime.utcnow()
+        if now is None:
+            now = datetime.datetime.utcnow()
+        val['_concordia_created_at'] = now
 
-        if isinstance(val, dict):
-            val = self.check_row_id(val=val, row_id=row_id)
-            val = self.check_model_id(val=val, model_id=model_id)
+        val = self.check_row_id(val=val, row_id=row_id)
+        val = self.check_model_id(val=val, model_id=model_id)
+
+        # Mongo can't encode numpy scalars, so convert them to their native python equivalents
+        normalize = self._get_normalizer(val_type=val_type, val=val)
+        return normalize(val)
 
-            for k, v in val.items():
-                if isinstance(v, np.generic):
-                    val[k] = np.asscalar(v)
 
-            self.mdb[val_type].insert_one(val)
+    # val can be a single dict, a list of dicts, or a pandas DataFrame
+    def insert_into_persistent_db(self, val, val_type, row_id=None, model_id=None):
+        if isinstance(val, dict):
+            val = self._prepare_doc(val=val, val_type=val_type, row_id=row_id, model_id=model_id)
+            if self.async_writes:
+                self._write_queue.put((val_type, [val]))
+            else:
+                self._insert_one(doc=val, val_type=val_type)
 
+        elif isinstance(val, list):
+            now = datetime.datetime.utcnow()
+            docs = [self._prepare_doc(val=doc, val_type=val_type, row_id=doc.get('row_id', row_id), model_id=doc.get('model_id', model_id), now=now) for doc in val]
+            self._insert_docs_into_db(docs=docs, val_type=val_type)
 
         else:
+            id_cols = [col for col in ['_id', '_id_'] if col in val.columns]
+            if len(id_cols) > 0:
+                val = val.drop(id_cols, axis=1)
+
             self._insert_df_into_db(df=val, val_type=val_type, row_id=row_id, model_id=model_id)
 
         return self
 
 
     def make_redis_model_key(self, model_id):
-        return '_concordia_{}_{}'.format(model_id, 'model')
+        # We look this up on every predict, so only build each key once
+        redis_key = self._redis_model_keys.get(model_id)
+        if redis_key is None:
+            redis_key = '_concordia_{}_{}'.format(model_id, 'model')
+            self._redis_model_keys[model_id] = redis_key
+        return redis_key
+
+
+    def make_redis_key_model_version(self, model_id):
+        return '_concordia_{}_{}'.format(model_id, 'model_version')
 
 
     def _get_model(self, model_id):
+        version = self.rdb.get(self.make_redis_key_model_version(model_id))
+        memoized = self._model_memo.pop(model_id, None)
+        if memoized is not None and memoized[0] == version:
+            # Move it to the most-recently-used end
+            self._model_memo[model_id] = memoized
+            return memoized[1]
+
         redis_key_model = self.make_redis_model_key(model_id)
         redis_result = self.rdb.get(redis_key_model)
         if redis_result is 'None' or redis_result is None:
             # Try to get it from MongoDB
-            mdb_result = self.retrieve_from_persistent_db(val_type='model_info', row_id=None, model_id=model_id)
+            mdb_result = self.retrieve_from_persistent_db(val_type='model_info', row_id=None, model_id=model_id, projection={'model': 1, 'model_sha': 1})
             if mdb_result is None or len(mdb_result) == 0:
                 print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
                 print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
@@ -284,13 +747,22 @@ class Concordia():
                 error_string = 'We could not find a corresponding model for model_id {}'.format(model_id)
                 raise(ValueError(error_string))
             else:
-                model = mdb_result[0]['model']
+                model_info = mdb_result[0]
+                if 'model' in model_info:
+                    # Older versions of Concordia saved the model directly on the model_info doc
+                    model = model_info['model']
+                else:
+                    model = self.mdb['model_objects'].find_one({'_id': model_info['model_sha']})['model']
 
+                # No need to read back what we just wrote- we already have it
                 self.rdb.set(redis_key_model, model)
-                redis_result = self.rdb.get(redis_key_model)
+                redis_result = model
 
 
-        redis_result = dill.loads(codecs.decode(redis_result, 'base64'))
+        redis_result = self._load_model(redis_result)
+        if len(self._model_memo) >= self._model_cache_size:
+            self._model_memo.popitem(last=False)
+        self._model_memo[model_id] = (version, redis_result)
 
         return redis_result
 
@@ -300,20 +772,19 @@ class Concordia():
         redis_result = self.rdb.get(redis_key)
 
         if redis_result is None or redis_result is 'None':
-            mdb_result = self.retrieve_from_persistent_db(val_type='model_info', row_id=None, model_id=model_id)
+            mdb_result = self.retrieve_from_persistent_db(val_type='model_info', row_id=None, model_id=model_id, projection={'features_to_save': 1})
             if mdb_result is None or len(mdb_result) == 0:
                 return 'all'
             else:
                 try:
-                    features = mdb_result[0]['features_to_save']
+                    features = _json_loads(mdb_result[0]['features_to_save'])
                 except KeyError:
-                    features = json.dumps('all')
-                self.rdb.set(redis_key, features)
-                redis_result = self.rdb.get(redis_key)
+                    features = 'all'
+                # No need to read back what we just wrote- we already have it
+                self.rdb.set(redis_key, _msgpack_dumps(features))
+                return features
 
-        if isinstance(redis_result, bytes):
-            redis_result = redis_result.decode('utf-8')
-        redis_result = json.loads(redis_result)
+        redis_result = _msgpack_loads(redis_result)
         return redis_result
 
 
@@ -338,28 +809,27 @@ class Concordia():
             features_to_save = list(features.columns)
         else:
             features_to_save = features_to_save + concordia_features_to_save
-        prediction_docs = []
-        for idx, pred in enumerate(predictions):
-            if type(pred) not in self.valid_prediction_types:
-                pred = list(pred)
-            pred_doc = {
-                'prediction': pred
-                , 'row_id': row_ids.iloc[idx]
-                , 'model_id': model_id
-            }
-            prediction_docs.append(pred_doc)
-        predictions_df = pd.DataFrame(prediction_docs)
+
+        # Build these column-wise, positionally matching each prediction and label to its row_id
+        row_id_values = np.asarray(row_ids)
+
+        if isinstance(predictions, np.ndarray):
+            # tolist converts nested predict_proba rows to lists in one pass
+            predictions = predictions.tolist()
+        else:
+            predictions = [pred if type(pred) in _VALID_PRED_TYPES else list(pred) for pred in predictions]
+        predictions_df = pd.DataFrame({
+            'prediction': predictions
+            , 'row_id': row_id_values
+            , 'model_id': model_id
+        })
 
         if actuals is not None:
-            actuals_docs = []
-            for idx, actual in enumerate(actuals):
-                actual_doc = {
-                    'label': actual
-                    , 'row_id': row_ids.iloc[idx]
-                    , 'model_id': model_id
-                }
-                actuals_docs.append(actual_doc)
-            actuals_df = pd.DataFrame(actuals_docs)
+            actuals_df = pd.DataFrame({
+                'label': np.asarray(actuals)
+                , 'row_id': row_id_values
+                , 'model_id': model_id
+            })
 
         saving_features = features[features_to_save]
         self.insert_into_persistent_db(val=saving_features, val_type='training_features')
@@ -404,8 +874,6 @@ class Concordia():
 
 
     def _predict(self, features=None, model_id=None, row_id=None, model_ids=None, shadow_models=None, proba=False):
-        features = features.copy()
-
         model = self._get_model(model_id=model_id)
 
         if row_id is None:
@@ -426,15 +894,8 @@ class Concordia():
             prediction = model.predict(features)
 
         # Mongo doesn't handle np.ndarrays. it prefers lists.
-        pred_for_saving = prediction
-        if isinstance(pred_for_saving, np.ndarray):
-            pred_for_saving = list(pred_for_saving)
-            clean_pred_for_saving = []
-            for item in pred_for_saving:
-                if isinstance(item, np.ndarray):
-                    item = list(item)
-                clean_pred_for_saving.append(item)
-            pred_for_saving = clean_pred_for_saving
+        # tolist converts nested arrays (like predict_proba output) and numpy scalars all the way down to native python types
+        pred_for_saving = prediction.tolist() if isinstance(prediction, np.ndarray) else prediction
 
         pred_doc = {
             'prediction': pred_for_saving
@@ -526,12 +987,8 @@ class Concordia():
         # TODO 2: add logging if we have values for both training and live, but no matches when merging
 
         # 1. Get live data (only after min_date)
-        live_predictions = self.retrieve_from_persistent_db(val_type='live_predictions', row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
         # 2. Get training_data (only after min_date- we are only supporting the use case of training data being added after live data)
-        training_predictions = self.retrieve_from_persistent_db(val_type='training_predictions', row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
-
-        live_predictions = pd.DataFrame(live_predictions)
-        training_predictions = pd.DataFrame(training_predictions)
+        live_predictions, training_predictions = self._retrieve_dfs(val_types=['live_predictions', 'training_predictions'], row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
 
 
         if ignore_nans == True:
@@ -669,12 +1126,8 @@ class Concordia():
     def analyze_feature_discrepancies(self, model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True, sample_rate=1.0):
 
         # 1. Get live data (only after min_date)
-        live_features = self.retrieve_from_persistent_db(val_type='live_features', row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
         # 2. Get training_data (only after min_date- we are only supporting the use case of training data being added after live data)
-        training_features = self.retrieve_from_persistent_db(val_type='training_features', row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
-
-        live_features = pd.DataFrame(live_features)
-        training_features = pd.DataFrame(training_features)
+        live_features, training_features = self._retrieve_dfs(val_types=['live_features', 'training_features'], row_id=None, model_id=model_id, min_date=min_date, date_field=date_field)
 
         if ignore_duplicates == True:
             if len(set(live_features['row_id'])) < live_features.shape[0]:
@@ -695,10 +1148,8 @@ class Concordia():
         # TODO: find columns missing from only one (train or live)
         # TODO: find rows missing frm only one (train or live)
 
-        model_info = self.retrieve_from_persistent_db(val_type='model_info', model_id=model_id)
-        feature_importances = json.loads(model_info[0]['feature_importances'])
-        if isinstance(feature_importances, str):
-            feature_importances = json.loads(feature_importances)
+        model_info = self.retrieve_from_persistent_db(val_type='model_info', model_id=model_id, projection={'feature_importances': 1})
+        feature_importances = self._load_feature_importances(model_info[0])
 
         column_comparison = self.find_missing_columns(df_live_and_train)
         matched_cols = column_comparison['matched_cols']
@@ -777,14 +1228,7 @@ class Concordia():
         return pd.Series(result)
 
     def _get_training_data_and_predictions(self, model_id, row_id=None):
-        training_features = self.retrieve_from_persistent_db(val_type='training_features', row_id=row_id, model_id=model_id)
-        training_features = pd.DataFrame(training_features)
-
-        training_predictions = self.retrieve_from_persistent_db(val_type='training_predictions', row_id=row_id, model_id=model_id)
-        training_predictions = pd.DataFrame(training_predictions)
-
-        training_labels = self.retrieve_from_persistent_db(val_type='training_labels', row_id=row_id, model_id=model_id)
-        training_labels = pd.DataFrame(training_labels)
+        training_features, training_predictions, training_labels = self._retrieve_dfs(val_types=['training_features', 'training_predictions', 'training_labels'], row_id=row_id, model_id=model_id)
 
         return training_features, training_predictions, training_labels
 
@@ -856,7 +1300,7 @@ class Concordia():
 
 
 
-def load_concordia(persistent_db_config=None):
+def load_concordia(persistent_db_config=None, mongo_client=None, redis_client=None):
     default_db_config = {
         'host': 'localhost'
         , 'port': 27017
@@ -867,7 +1311,11 @@ def load_concordia(persistent_db_config=None):
         default_db_config.update(persistent_db_config)
 
     # FUTURE: allow the user to pass in a custom query/db connection, replicating what we do when they do a custom replace of retrieve_from_persistent_db
-    client = MongoClient(host=default_db_config['host'], port=default_db_config['port'])
+    # This is the same client the Concordia instance below will use, so we only pay for the connection once
+    if mongo_client is not None:
+        client = mongo_client
+    else:
+        client = Concordia._get_mongo_client(host=default_db_config['host'], port=default_db_config['port'])
     mdb = client[default_db_config['db']]
     concordia_info = mdb['concordia_config'].find_one({})
 
@@ -880,6 +1328,6 @@ def load_concordia(persistent_db_config=None):
     if '_concordia_created_at' in concordia_info:
         del concordia_info['_concordia_created_at']
 
-    concord = Concordia(**concordia_info)
+    concord = Concordia(mongo_client=mongo_client, redis_client=redis_client, **concordia_info)
 
     return concord
@@ -71,10 +71,14 @@ setup(
     install_requires=[
         'auto_ml>=2.9.4',
         'dill>=0.2.3, <0.3',
+        'msgpack>=0.5.2',
         'pymongo>3.0, <4.0',
         'redis>2.0, <3.0'
     ],
 
-    test_suite='nose.collector',
-    tests_require=['nose', 'coveralls']
+    extras_require={
+        'fast': ['orjson']
+    },
+
+    tests_require=['pytest', 'pytest-cov', 'coveralls']
 )
@@ -1,9 +1,13 @@
+import hashlib
+import importlib
 import os
+import pickle
 import sys
 
 sys.path = [os.path.join(os.path.abspath(os.getcwd()), 'auto_ml')] + sys.path
 os.environ['is_test_suite'] = 'True'
 
+import dill
 import numpy as np
 import pandas as pd
 from sklearn.datasets import load_boston
@@ -60,6 +64,73 @@ def train_basic_binary_classifier():
     return ml_predictor, df_titanic_test
 
 
+def _get_fixture_cache_key():
+    # Keyed on this file's source, so changing how we train invalidates the cache, and on the versions of everything that goes into the pickle, so upgrading any of them does too
+    with open(os.path.abspath(__file__).replace('.pyc', '.py'), 'rb') as source_file:
+        cache_key = hashlib.sha1(source_file.read())
+
+    cache_key.update(sys.version.encode('utf-8'))
+    for module_name in ['auto_ml', 'sklearn', 'lightgbm', 'dill', 'numpy', 'pandas']:
+        try:
+            version = getattr(importlib.import_module(module_name), '__version__', 'unknown')
+        except ImportError:
+            version = 'not installed'
+        cache_key.update('{}=={}'.format(module_name, version).encode('utf-8'))
+
+    return cache_key.hexdigest()
+
+
+def load_or_train_basic_binary_classifier(cache_dir=None):
+    # Training dominates test startup, so we cache the trained model (and the test split it goes with) on disk
+    # conftest passes in a dir inside pytest's own cache for this checkout, rather than somewhere shared like the system temp dir. Without a cache_dir, we just train
+    ml_predictor = None
+    if cache_dir is not None:
+        file_name = os.path.join(cache_dir, 'concordia_fixture_{}.dill'.format(_get_fixture_cache_key()))
+        if os.path.isfile(file_name):
+            try:
+                with open(file_name, 'rb') as cache_file:
+                    ml_predictor, df_titanic_test = dill.load(cache_file)
+            except Exception as e:
+                print('Could not load the cached test fixture, so we will train it again')
+                print(e)
+                ml_predictor = None
+
+    if ml_predictor is None:
+        ml_predictor, df_titanic_test = train_basic_binary_classifier()
+        if cache_dir is not None:
+            temp_file_name = '{}.{}'.format(file_name, os.getpid())
+            with open(temp_file_name, 'wb') as cache_file:
+                dill.dump((ml_predictor, df_titanic_test), cache_file, protocol=dill.HIGHEST_PROTOCOL)
+            os.rename(temp_file_name, file_name)
+        # Make sure the tests always run against a model that's been through serialization
+        ml_predictor = round_trip_in_memory(ml_predictor)
+
+    # auto_ml's own save/load goes through the filesystem. CI can opt back into exercising it
+    if os.environ.get('CONCORDIA_TEST_DISK_IO') == '1':
+        from auto_ml.utils_models import load_ml_model
+        saved_file_name = '_test_suite_saved_pipeline.dill'
+        ml_predictor.save(saved_file_name)
+        ml_predictor = load_ml_model(saved_file_name)
+        os.remove(saved_file_name)
+
+    return ml_predictor, df_titanic_test
+
+
+def round_trip_in_memory(obj):
+    # Protocol 5 hands numpy's buffers to us out-of-band, rather than copying them into the pickle
+    # The dill versions we support don't take buffer_callback, so that part goes through pickle itself
+    if pickle.HIGHEST_PROTOCOL >= 5:
+        buffers = []
+        try:
+            data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        except Exception:
+            # Some objects (lambdas, closures) can only be pickled by dill
+            pass
+        else:
+            return pickle.loads(data, buffers=buffers)
+    return dill.loads(dill.dumps(obj, protocol=dill.HIGHEST_PROTOCOL))
+
+
 def train_basic_regressor(df_boston_train):
     np.random.seed(0)
 
@@ -0,0 +1,79 @@
+from argparse import Namespace
+import os
+import sys
+
+from pymongo import MongoClient
+import pytest
+
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+sys.path = [os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')] + sys.path
+os.environ['is_test_suite'] = 'True'
+
+import redis
+
+from concordia import Concordia
+
+# Under pytest-xdist (pytest -n 4 --dist loadgroup), each worker gets its own Mongo db and Redis db, so workers never trample each other's data
+# Redis only has 16 dbs by default, so this supports up to 8 workers
+_worker_id = os.environ.get('PYTEST_XDIST_WORKER')
+_worker_num = int(_worker_id[2:]) if _worker_id is not None else 0
+if _worker_num >= 8:
+    raise pytest.UsageError('Each pytest-xdist worker needs its own Redis db (8 through 15), so the test suite supports at most 8 workers. Run it with -n 8 or fewer.')
+
+persistent_db_config = {
+    'db': '__concordia_test_env' if _worker_id is None else '__concordia_test_env_{}'.format(_worker_id)
+    , 'host': 'localhost'
+    , 'port': 27017
+}
+
+in_memory_db_config = {
+    'db': 8 + _worker_num
+    , 'host': 'localhost'
+    , 'port': 6379
+}
+
+# One pooled client for each db, shared by everything in the test run, so we only pay for connection setup once
+_MONGO = MongoClient(host=persistent_db_config['host'], port=persistent_db_config['port'], maxPoolSize=50)
+_REDIS = redis.StrictRedis(connection_pool=redis.ConnectionPool(host=in_memory_db_config['host'], port=in_memory_db_config['port'], db=in_memory_db_config['db'], max_connections=32))
+
+
+@pytest.fixture(scope='session')
+def env(request):
+    import aml_utils
+
+    ####################################################################
+    # Setup- train model, create direct db connections, set global constants, etc.
+    # Each test module overrides this fixture to add its own Concordia instance on top
+    #####################################################################
+    # TODO: create another model that uses a different algo (logisticRegression, perhaps), so we can have tests for our logic when using multiple models but each predicting off the same features
+    fixture_cache_dir = str(request.config.cache.makedir('concordia_fixture'))
+    ml_predictor_titanic, df_titanic_test = aml_utils.load_or_train_basic_binary_classifier(cache_dir=fixture_cache_dir)
+    # Building these once up front is much cheaper than calling .iloc[idx].to_dict() in every test. Copy one before changing it
+    row_dicts = df_titanic_test.to_dict(orient='records')
+    importances_dict = ml_predictor_titanic.feature_importances_
+    # Plain arrays, so tests don't drag a pandas index along with every batch of row_ids or labels they hand to Concordia
+    name_arr = df_titanic_test['name'].values
+    survived_arr = df_titanic_test['survived'].values
+
+    rdb = _REDIS
+    mongo_client = _MONGO
+    mdb = mongo_client[persistent_db_config['db']]
+
+    # test_1_basics resets the dbs and creates the Concordia that the other modules load. Under xdist, those modules can land on a worker where that hasn't happened yet, so make sure there's something for them to load
+    if mdb['concordia_config'].find_one({}) is None:
+        Concordia(in_memory_db_config=in_memory_db_config, persistent_db_config=persistent_db_config, default_row_id_field='name', mongo_client=mongo_client, redis_client=rdb)
+
+    return Namespace(
+        ml_predictor_titanic=ml_predictor_titanic
+        , df_titanic_test=df_titanic_test
+        , row_dicts=row_dicts
+        , importances_dict=importances_dict
+        , name_arr=name_arr
+        , survived_arr=survived_arr
+        , rdb=rdb
+        , mdb=mdb
+        , mongo_client=mongo_client
+        , persistent_db_config=persistent_db_config
+        , in_memory_db_config=in_memory_db_config
+    )
+
@@ -1,89 +1,46 @@
-import os
+from argparse import Namespace
 import random
-import sys
-import time
 import warnings
 
-from auto_ml import load_ml_model
-import dill
-from nose.tools import raises
 import numpy as np
 import pandas as pd
-from pymongo import MongoClient
-
-sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
-sys.path = [os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')] + sys.path
-os.environ['is_test_suite'] = 'True'
-
-import redis
+import pytest
 
 from concordia import Concordia, load_concordia
 
-def do_setup():
-    import aml_utils
-
-    ####################################################################
-    # Setup- train model, create direct db connections, set global constants, etc.
-    #####################################################################
-    # TODO: create another model that uses a different algo (logisticRegression, perhaps), so we can have tests for our logic when using multiple models but each predicting off the same features
-    ml_predictor_titanic, df_titanic_test = aml_utils.train_basic_binary_classifier()
-    file_name = '_test_suite_saved_pipeline.dill'
-    ml_predictor_titanic.save(file_name)
-    ml_predictor_titanic = load_ml_model(file_name)
-    os.remove(file_name)
-
-
-    persistent_db_config = {
-        'db': '__concordia_test_env'
-        , 'host': 'localhost'
-        , 'port': 27017
-    }
-
-    in_memory_db_config = {
-        'db': 8
-        , 'host': 'localhost'
-        , 'port': 6379
-    }
-
-
-    host = in_memory_db_config['host']
-    port = in_memory_db_config['port']
-    db = in_memory_db_config['db']
-    rdb = redis.StrictRedis(host=host, port=port, db=db)
-
-    host = persistent_db_config['host']
-    port = persistent_db_config['port']
-    db = persistent_db_config['db']
-    client = MongoClient(host=host, port=port)
-    mdb = client[db]
+model_id = 'ml_predictor_titanic_3'
 
-    concord = load_concordia(persistent_db_config=persistent_db_config)
+# Under xdist, keep this module's tests together on one worker, in order
+pytestmark = pytest.mark.xdist_group('analytics')
 
-    existing_training_rows, _, _ = concord._get_training_data_and_predictions(model_id)
-    len_existing_training_rows = existing_training_rows.shape[0]
 
-    existing_live_rows = concord.retrieve_from_persistent_db(val_type='live_features', row_id=None, model_id=model_id)
-    len_existing_live_rows = len(existing_live_rows)
+@pytest.fixture(scope='module')
+def env(env):
+    # Work on our own copy, so nothing this module changes leaks into the other test modules
+    env = Namespace(**vars(env))
+    env.df_titanic_test = env.df_titanic_test.copy()
 
-    return ml_predictor_titanic, df_titanic_test, concord, rdb, mdb, len_existing_training_rows, len_existing_live_rows
+    env.concord = load_concordia(persistent_db_config=env.persistent_db_config, mongo_client=env.mongo_client, redis_client=env.rdb)
 
-model_id = 'ml_predictor_titanic_3'
+    existing_training_rows, _, _ = env.concord._get_training_data_and_predictions(model_id)
+    env.len_existing_training_rows = existing_training_rows.shape[0]
 
-ml_predictor_titanic, df_titanic_test, concord, rdb, mdb, len_existing_training_rows, len_existing_live_rows = do_setup()
+    existing_live_rows = env.concord.retrieve_from_persistent_db(val_type='live_features', row_id=None, model_id=model_id, projection={'_id': 1})
+    env.len_existing_live_rows = len(existing_live_rows)
 
+    env.len_existing_live_preds = len(env.concord.retrieve_from_persistent_db(val_type='live_predictions', projection={'_id': 1}))
 
-len_existing_live_preds = len(concord.retrieve_from_persistent_db(val_type='live_predictions'))
+    return env
 
 
-
-def test_compare_proba_predictions_finds_a_fixed_delta_of_1():
+def test_compare_proba_predictions_finds_a_fixed_delta_of_1(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict_proba(model_id, df_titanic_test)
+    env.concord.predict_proba(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict_proba(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict_proba(env.df_titanic_test)
 
     modified_preds = []
     for pred in train_preds:
@@ -91,9 +48,9 @@ def test_compare_proba_predictions_finds_a_fixed_delta_of_1():
         pred[1] = pred[1] + 0.1
         modified_preds.append(pred)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=modified_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=modified_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
+    results = env.concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
 
     deltas = results['deltas']
 
@@ -103,18 +60,18 @@ def test_compare_proba_predictions_finds_a_fixed_delta_of_1():
     assert class_1_delta_val == 0.10000
 
 
-def test_compare_proba_predictions_finds_no_deltas_when_deltas_do_not_exist():
+def test_compare_proba_predictions_finds_no_deltas_when_deltas_do_not_exist(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict_proba(model_id, df_titanic_test)
+    env.concord.predict_proba(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict_proba(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict_proba(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
+    results = env.concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
 
     deltas = results['deltas']
 
@@ -124,23 +81,23 @@ def test_compare_proba_predictions_finds_no_deltas_when_deltas_do_not_exist():
     assert class_1_delta_val == 0
 
 
-def test_compare_predict_predictions_finds_a_fixed_delta_of_1():
+def test_compare_predict_predictions_finds_a_fixed_delta_of_1(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
     modified_preds = []
     for pred in train_preds:
         pred = pred - 0.1
         modified_preds.append(pred)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=modified_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=modified_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
+    results = env.concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
 
     deltas = results['deltas']
 
@@ -148,25 +105,25 @@ def test_compare_predict_predictions_finds_a_fixed_delta_of_1():
     assert prediction_delta_val == -0.10000
 
 
-def test_compare_predict_predictions_finds_no_deltas_when_deltas_do_not_exist():
+def test_compare_predict_predictions_finds_no_deltas_when_deltas_do_not_exist(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
+    results = env.concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True)
 
     deltas = results['deltas']
     prediction_delta_val = round(deltas['delta'].mean(), 5)
     assert prediction_delta_val == 0
 
 
-def test_find_missing_cols():
+def test_find_missing_cols(env):
     columns = [
         'feature_1'
         , 'feature_2_train'
@@ -179,7 +136,7 @@ def test_find_missing_cols():
         , 'feature_5_train'
     ]
     df = pd.DataFrame(0, index=np.arange(10), columns=columns)
-    results = concord.find_missing_columns(df)
+    results = env.concord.find_missing_columns(df)
 
     assert len(results['matched_cols']) == 2
     assert 'feature_2' in results['matched_cols']
@@ -190,18 +147,18 @@ def test_find_missing_cols():
     assert 'feature_5' in results['train_columns_not_in_live']
 
 
-def test_compare_features_finds_no_deltas_when_deltas_do_not_exist():
+def test_compare_features_finds_no_deltas_when_deltas_do_not_exist(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
+    results = env.concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
 
     print('results')
     print(results)
@@ -212,18 +169,18 @@ def test_compare_features_finds_no_deltas_when_deltas_do_not_exist():
         assert prediction_delta_val == 0
 
 
-def test_compare_features_works_even_with_no_feature_importances():
+def test_compare_features_works_even_with_no_feature_importances(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=None)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=None)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
+    results = env.concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
 
     print('results')
     print(results)
@@ -234,36 +191,36 @@ def test_compare_features_works_even_with_no_feature_importances():
         assert prediction_delta_val == 0
 
 
-@raises(TypeError)
-def test_bad_feature_importances_type_raises_type_error():
-    model_id = 'ml_predictor_titanic_{}'.format(random.random())
+def test_bad_feature_importances_type_raises_type_error(env):
+    with pytest.raises(TypeError):
+        model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=['this will not work'])
+        env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=['this will not work'])
 
 
 
-def test_compare_features_finds_deltas_when_deltas_do_exist():
+def test_compare_features_finds_deltas_when_deltas_do_exist(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
     col_deltas = {}
-    for col in df_titanic_test.columns:
-        if df_titanic_test[col].dtype != 'object':
+    for col in env.df_titanic_test.columns:
+        if env.df_titanic_test[col].dtype != 'object':
             col_delta = random.random()
-            df_titanic_test[col] = df_titanic_test[col] - col_delta
+            env.df_titanic_test[col] = env.df_titanic_test[col] - col_delta
             col_deltas[col] = col_delta
         else:
             col_deltas[col] = 0
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
+    results = env.concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
 
     deltas = results['deltas']
     for col in deltas.columns:
@@ -277,40 +234,63 @@ def test_compare_features_finds_deltas_when_deltas_do_exist():
             assert prediction_delta_val == -delta_val
 
 
-def test_raises_warning_when_it_appears_row_id_types_mismatch():
+def test_raises_warning_when_it_appears_row_id_types_mismatch(env):
     model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+    env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
 
-    concord.predict(model_id, df_titanic_test)
+    env.concord.predict(model_id, env.df_titanic_test)
 
-    df_titanic_test['name'] = df_titanic_test.name.apply(lambda val: '{}_{}'.format(val, random.random()))
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
+    env.df_titanic_test['name'] = env.df_titanic_test.name.apply(lambda val: '{}_{}'.format(val, random.random()))
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+    env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
 
     with warnings.catch_warnings(record=True) as w:
-        results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
+        results = env.concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, sort_column=None, min_date=None, date_field=None, verbose=True, ignore_duplicates=True)
         assert len(w) == 1
 
     assert results['deltas'].shape[0] == 0
 
 
-@raises(TypeError)
-def test_raises_error_when_date_is_specified_without_datefield_but_min_date_is_not_datetime():
-    model_id = 'ml_predictor_titanic_{}'.format(random.random())
+def test_raises_error_when_date_is_specified_without_datefield_but_min_date_is_not_datetime(env):
+    with pytest.raises(TypeError):
+        model_id = 'ml_predictor_titanic_{}'.format(random.random())
+
+        env.concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
+
+        env.concord.predict(model_id, env.df_titanic_test)
 
-    concord.add_model(model=ml_predictor_titanic, model_id=model_id, feature_importances=ml_predictor_titanic.feature_importances_)
+        train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
 
-    concord.predict(model_id, df_titanic_test)
+        env.concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    train_preds = ml_predictor_titanic.predict(df_titanic_test)
 
-    concord.add_data_and_predictions(model_id=model_id, features=df_titanic_test, predictions=train_preds, row_ids=df_titanic_test.name, actuals=df_titanic_test.survived)
+        results = env.concord.analyze_prediction_discrepancies(model_id=model_id, min_date='12345', date_field=None)
+
+        assert False
+
+
+
+def test_reads_run_concurrently_with_acknowledged_writes(env):
+    # The test suite uses unacknowledged writes by default, which makes reads run one at a time. Acknowledged writes send them through the shared read pool instead
+    concord = Concordia(in_memory_db_config=env.in_memory_db_config, persistent_db_config=env.persistent_db_config, default_row_id_field='name', write_concern={'w': 1}, mongo_client=env.mongo_client, redis_client=env.rdb)
+    model_id = 'ml_predictor_titanic_{}'.format(random.random())
 
+    concord.add_model(model=env.ml_predictor_titanic, model_id=model_id, feature_importances=env.importances_dict)
+    concord.predict(model_id, env.df_titanic_test)
+    train_preds = env.ml_predictor_titanic.predict(env.df_titanic_test)
+    concord.add_data_and_predictions(model_id=model_id, features=env.df_titanic_test, predictions=train_preds, row_ids=env.df_titanic_test.name, actuals=env.df_titanic_test.survived)
 
-    results = concord.analyze_prediction_discrepancies(model_id=model_id, min_date='12345', date_field=None)
+    training_features, training_predictions, training_labels = concord._get_training_data_and_predictions(model_id)
+    assert training_features.shape[0] == env.df_titanic_test.shape[0]
+    assert training_predictions.shape[0] == env.df_titanic_test.shape[0]
+    assert training_labels.shape[0] == env.df_titanic_test.shape[0]
 
-    assert False
+    results = concord.analyze_prediction_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, verbose=False, ignore_duplicates=True)
+    assert round(results['deltas']['delta'].mean(), 5) == 0
 
+    results = concord.analyze_feature_discrepancies(model_id=model_id, return_summary=True, return_deltas=True, return_matched_rows=False, verbose=False, ignore_duplicates=True)
+    for col in results['deltas'].columns:
+        assert round(results['deltas'][col].mean(), 5) == 0
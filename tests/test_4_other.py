@@ -1,130 +1,233 @@
-import os
+from argparse import Namespace
+import codecs
+from decimal import Decimal
+from fractions import Fraction
+import json
 import random
-import sys
-import time
+import threading
 import warnings
 
-from auto_ml import load_ml_model
 import dill
-from nose.tools import raises
 import numpy as np
-from pymongo import MongoClient
+from pymongo.cursor import Cursor
+import pytest
 
-sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
-sys.path = [os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')] + sys.path
-os.environ['is_test_suite'] = 'True'
+from concordia import Concordia, load_concordia
+from concordia.Concordia_logic import _is_scalar, _restore_mongo_key, _sanitize_mongo_key
 
-import redis
+model_id = 'ml_predictor_titanic_3'
 
-from concordia import Concordia, load_concordia
+# Under xdist, keep this module's tests together on one worker, in order
+pytestmark = pytest.mark.xdist_group('other')
 
-def do_setup():
-    import aml_utils
 
-    ####################################################################
-    # Setup- train model, create direct db connections, set global constants, etc.
-    #####################################################################
-    # TODO: create another model that uses a different algo (logisticRegression, perhaps), so we can have tests for our logic when using multiple models but each predicting off the same features
-    ml_predictor_titanic, df_titanic_test = aml_utils.train_basic_binary_classifier()
-    file_name = '_test_suite_saved_pipeline.dill'
-    ml_predictor_titanic.save(file_name)
-    ml_predictor_titanic = load_ml_model(file_name)
-    os.remove(file_name)
+@pytest.fixture(scope='module')
+def env(env):
+    # Work on our own copy, so nothing this module changes leaks into the other test modules
+    env = Namespace(**vars(env))
+    env.df_titanic_test = env.df_titanic_test.copy()
 
+    env.concord = load_concordia(persistent_db_config=env.persistent_db_config, mongo_client=env.mongo_client, redis_client=env.rdb)
 
+    existing_training_rows, _, _ = env.concord._get_training_data_and_predictions(model_id)
+    env.len_existing_training_rows = existing_training_rows.shape[0]
 
-    persistent_db_config = {
-        'db': '__concordia_test_env'
-        , 'host': 'localhost'
-        , 'port': 27017
-    }
+    existing_live_rows = env.concord.retrieve_from_persistent_db(val_type='live_features', row_id=None, model_id=model_id, projection={'_id': 1})
+    env.len_existing_live_rows = len(existing_live_rows)
 
-    in_memory_db_config = {
-        'db': 8
-        , 'host': 'localhost'
-        , 'port': 6379
-    }
+    env.len_existing_live_preds = len(env.concord.retrieve_from_persistent_db(val_type='live_predictions', projection={'_id': 1}))
 
+    return env
 
-    host = in_memory_db_config['host']
-    port = in_memory_db_config['port']
-    db = in_memory_db_config['db']
-    rdb = redis.StrictRedis(host=host, port=port, db=db)
 
-    host = persistent_db_config['host']
-    port = persistent_db_config['port']
-    db = persistent_db_config['db']
-    client = MongoClient(host=host, port=port)
-    mdb = client[db]
+def test_df_no_row_id_is_ok_with_default_row_id_feild(env):
 
-    concord = load_concordia(persistent_db_config=persistent_db_config)
+    features = env.df_titanic_test[:15].copy()
 
-    existing_training_rows, _, _ = concord._get_training_data_and_predictions(model_id)
-    len_existing_training_rows = existing_training_rows.shape[0]
+    if 'row_id' in features.columns:
+        features = features.drop('row_id')
 
-    existing_live_rows = concord.retrieve_from_persistent_db(val_type='live_features', row_id=None, model_id=model_id)
-    len_existing_live_rows = len(existing_live_rows)
+    assert 'row_id' not in features.columns
+    assert 'name' in features.columns
 
-    return ml_predictor_titanic, df_titanic_test, concord, rdb, mdb, len_existing_training_rows, len_existing_live_rows
+    env.concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=model_id)
 
-model_id = 'ml_predictor_titanic_3'
+    assert True
 
-ml_predictor_titanic, df_titanic_test, concord, rdb, mdb, len_existing_training_rows, len_existing_live_rows = do_setup()
+def test_df_no_row_id_raises_error_with_no_row_id_field(env):
+    with pytest.raises(ValueError):
+        features = env.df_titanic_test[:15].copy()
+        del features['name']
 
+        assert 'row_id' not in features.columns
+        assert 'name' not in features.columns
 
-len_existing_live_preds = len(concord.retrieve_from_persistent_db(val_type='live_predictions'))
+        env.concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=model_id)
 
+        assert False
 
-def test_df_no_row_id_is_ok_with_default_row_id_feild():
 
-    features = df_titanic_test[:15].copy()
+def test_df_no_model_id_raises_error_always(env):
+    with pytest.raises(ValueError):
+        features = env.df_titanic_test[:15].copy()
+        assert 'row_id' not in features.columns
+        assert 'name' in features.columns
 
-    if 'row_id' in features.columns:
-        features = features.drop('row_id')
+        env.concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=None)
 
-    assert 'row_id' not in features.columns
-    assert 'name' in features.columns
+        assert False
 
-    concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=model_id)
 
-    assert True
+def test_retrieve_from_persistent_db_returns_a_list_unless_told_not_to_materialize(env):
 
-@raises(ValueError)
-def test_df_no_row_id_raises_error_with_no_row_id_field():
+    result = env.concord.retrieve_from_persistent_db(val_type='training_features', model_id=model_id)
+    assert isinstance(result, list)
+    assert len(result) > 0
 
-    features = df_titanic_test[:15].copy()
-    del features['name']
+    cursor = env.concord.retrieve_from_persistent_db(val_type='training_features', model_id=model_id, materialize=False)
+    assert isinstance(cursor, Cursor)
+    assert len(list(cursor)) == len(result)
 
-    assert 'row_id' not in features.columns
-    assert 'name' not in features.columns
 
-    concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=model_id)
+def make_async_concordia(env):
+    # Acknowledged writes, so that once flush returns, everything it wrote is visible to our reads
+    return Concordia(in_memory_db_config=env.in_memory_db_config, persistent_db_config=env.persistent_db_config, default_row_id_field='name', write_concern={'w': 1}, async_writes=True, mongo_client=env.mongo_client, redis_client=env.rdb)
 
-    assert False
 
+def test_async_writes_are_all_readable_after_flush(env):
+    concord = make_async_concordia(env)
+    async_model_id = 'ml_predictor_titanic_async_{}'.format(random.random())
+    concord.add_model(model=env.ml_predictor_titanic, model_id=async_model_id)
 
-@raises(ValueError)
-def test_df_no_model_id_raises_error_always():
+    features = env.df_titanic_test[:20]
+    concord.predict(async_model_id, features)
+    concord.flush()
 
-    features = df_titanic_test[:15].copy()
-    assert 'row_id' not in features.columns
-    assert 'name' in features.columns
+    live_features = concord.retrieve_from_persistent_db(val_type='live_features', model_id=async_model_id, projection={'_id': 1})
+    live_preds = concord.retrieve_from_persistent_db(val_type='live_predictions', model_id=async_model_id, projection={'_id': 1})
+    assert len(live_features) == features.shape[0]
+    assert len(live_preds) == features.shape[0]
 
-    concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=None)
 
-    assert False
+def test_async_writes_failing_for_one_val_type_still_write_the_others(env, monkeypatch):
+    concord = make_async_concordia(env)
+    async_model_id = 'ml_predictor_titanic_async_{}'.format(random.random())
+    concord.add_model(model=env.ml_predictor_titanic, model_id=async_model_id)
+    concord.flush()
 
+    release_writer = threading.Event()
+    bulk_insert_docs = concord._bulk_insert_docs
 
-@raises(ValueError)
-def test_df_no_model_id_raises_error_always():
+    def flaky_bulk_insert_docs(docs, val_type):
+        if val_type == '_test_blocker':
+            release_writer.wait()
+            return
+        if val_type == 'live_features':
+            raise ValueError('Simulated write failure')
+        return bulk_insert_docs(docs=docs, val_type=val_type)
+
+    monkeypatch.setattr(concord, '_bulk_insert_docs', flaky_bulk_insert_docs)
+
+    # Hold the writer up until both of predict's writes are queued, so they go out in the same batch
+    concord._write_queue.put(('_test_blocker', [{}]))
+    features = env.df_titanic_test[:20]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        concord.predict(async_model_id, features)
+        release_writer.set()
+        concord.flush()
+
+    live_features = concord.retrieve_from_persistent_db(val_type='live_features', model_id=async_model_id, projection={'_id': 1})
+    live_preds = concord.retrieve_from_persistent_db(val_type='live_predictions', model_id=async_model_id, projection={'_id': 1})
+    assert len(live_features) == 0
+    assert len(live_preds) == features.shape[0]
+
+
+def test_bulk_add_models_loads_through_redis_and_then_mongo(env):
+    model_ids = ['ml_predictor_titanic_bulk_{}'.format(random.random()) for _ in range(3)]
+    # The first two are the exact same model, so they share a single saved copy in model_objects
+    models = [
+        {'model': env.ml_predictor_titanic, 'model_id': model_ids[0], 'feature_importances': env.importances_dict}
+        , {'model': env.ml_predictor_titanic, 'model_id': model_ids[1]}
+        , {'model': {'not_actually': 'a model'}, 'model_id': model_ids[2], 'features_to_save': ['age', 'fare']}
+    ]
+    env.concord.bulk_add_models(models)
+
+    model_info = env.concord.retrieve_from_persistent_db(val_type='model_info', projection={'model_id': 1, 'model_sha': 1})
+    model_shas = {doc['model_id']: doc['model_sha'] for doc in model_info if doc['model_id'] in model_ids}
+    assert len(model_shas) == 3
+    assert model_shas[model_ids[0]] == model_shas[model_ids[1]]
+    assert model_shas[model_ids[0]] != model_shas[model_ids[2]]
+    assert len(list(env.mdb['model_objects'].find({'_id': {'$in': list(model_shas.values())}}, {'_id': 1}))) == 2
+
+    def check_models(concord):
+        assert type(concord._get_model(model_ids[0])) == type(env.ml_predictor_titanic)
+        assert type(concord._get_model(model_ids[1])) == type(env.ml_predictor_titanic)
+        assert concord._get_model(model_ids[2]) == {'not_actually': 'a model'}
+        assert concord._get_features_to_save(model_ids[2]) == ['age', 'fare']
+
+    check_models(env.concord)
+
+    for bulk_model_id in model_ids:
+        env.rdb.delete(env.concord.make_redis_model_key(bulk_model_id), env.concord.make_redis_key_model_version(bulk_model_id), env.concord.make_redis_key_features(bulk_model_id))
+    # A freshly loaded instance, with nothing in memory and nothing in Redis, has to get everything from MongoDB
+    check_models(load_concordia(persistent_db_config=env.persistent_db_config, mongo_client=env.mongo_client, redis_client=env.rdb))
+
+
+def test_bulk_add_models_with_no_models_is_a_no_op(env):
+    assert env.concord.bulk_add_models([]) is env.concord
+
+
+def test_deserialize_model_loads_legacy_base64_dill_models(env):
+    legacy_blob = codecs.encode(dill.dumps({'not_actually': 'a model'}), 'base64')
+    assert env.concord._deserialize_model(legacy_blob) == {'not_actually': 'a model'}
+
+
+def test_deserialize_model_surfaces_the_real_error_for_models_that_fail_to_unpickle(env):
+    # A protocol 2 pickle of a class from a module that no longer exists
+    model_blob = b'\x80\x02c__concordia_missing_module__\nMovedModel\nq\x00.'
+    with pytest.raises(ImportError):
+        env.concord._deserialize_model(model_blob)
+
+
+def test_is_scalar_recognizes_scalars_beyond_the_common_types(env):
+    assert _is_scalar('Allen, Miss. Elisabeth Walton')
+    assert _is_scalar(np.int64(12))
+    assert _is_scalar(Decimal('12.5'))
+    assert _is_scalar(Fraction(1, 3))
+
+    assert not _is_scalar(['a', 'b'])
+    assert not _is_scalar(np.array([1, 2]))
+    assert not _is_scalar(env.df_titanic_test['name'])
+
+
+def test_feature_importances_saved_as_legacy_json_strings_still_load(env):
+    feature_importances = {'age': 0.5, 'fare': 0.25}
+    assert env.concord._load_feature_importances({'feature_importances': json.dumps(feature_importances)}) == feature_importances
+    assert env.concord._load_feature_importances({'feature_importances': json.dumps(json.dumps(feature_importances))}) == feature_importances
+    assert env.concord._load_feature_importances({'feature_importances': u'{"age": 0.5, "fare": 0.25}'}) == feature_importances
+
+
+def test_mongo_keys_round_trip_non_ascii_and_non_string_feature_names(env):
+    feature_name = u'ticket.pr\u00efce'
+    assert _sanitize_mongo_key(feature_name) == u'ticket_DOT_pr\u00efce'
+    assert _restore_mongo_key(_sanitize_mongo_key(feature_name)) == feature_name
+    assert _sanitize_mongo_key(12) == '12'
 
-    features = df_titanic_test[:15].copy()
-    assert 'row_id' not in features.columns
-    assert 'name' in features.columns
 
-    concord._insert_df_into_db(df=features, val_type='training_features', row_id=None, model_id=None)
+def test_normalizers_are_reused_when_docs_alternate_between_feature_sets(env):
+    doc_a = {'row_id': 'a', 'model_id': model_id, 'age': np.float64(22.0)}
+    doc_b = {'row_id': 'b', 'model_id': model_id, 'fare': np.float64(7.25), 'pclass': np.int64(3)}
+
+    normalize_a = env.concord._get_normalizer(val_type='live_features', val=doc_a)
+    normalize_b = env.concord._get_normalizer(val_type='live_features', val=doc_b)
+    assert normalize_a is not normalize_b
+    assert env.concord._get_normalizer(val_type='live_features', val=doc_a) is normalize_a
+    assert env.concord._get_normalizer(val_type='live_features', val=doc_b) is normalize_b
 
-    assert False
+    normalized = normalize_b(dict(doc_b))
+    assert type(normalized['fare']) == float
+    assert type(normalized['pclass']) == int
 
 
 # def test_add_data_and_predictions_takes_in_dicts():